@@ -2,7 +2,7 @@ import pandas as pd
 import numpy as np
 import itertools
 
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, issparse
 import logging
 
 
@@ -135,7 +135,7 @@ class AffinityMatrix:
     def map_back_sparse(self, X, kind):
         """Map back the user/affinity matrix to a pd dataframe
         Args:
-            X (numpy.ndarray, int32): user/item affinity matrix
+            X (numpy.ndarray or scipy.sparse matrix, int32): user/item affinity matrix
             kind (string): specify if the output values are ratings or predictions
         Returns:
             pandas.DataFrame: the generated pandas dataframe
@@ -143,18 +143,23 @@ class AffinityMatrix:
         m, n = X.shape
 
         # 1) Create a DF from a sparse matrix
-        # obtain the non zero items
-        items = [np.asanyarray(np.where(X[i, :] != 0)).flatten() for i in range(m)]
-        ratings = [X[i, items[i]] for i in range(m)]  # obtain the non-zero ratings
-
-        # Creates user ids following the DF format
-        userids = []
-        for i in range(0, m):
-            userids.extend([i] * len(items[i]))
-
-        # Flatten the lists to follow the DF input format
-        items = list(itertools.chain.from_iterable(items))
-        ratings = list(itertools.chain.from_iterable(ratings))
+        if issparse(X):
+            # the stored elements are used as they are, in their order within each row
+            X = X.tocoo()
+            userids, items, ratings = X.row, X.col, X.data
+        else:
+            # obtain the non zero items
+            items = [np.asanyarray(np.where(X[i, :] != 0)).flatten() for i in range(m)]
+            ratings = [X[i, items[i]] for i in range(m)]  # obtain the non-zero ratings
+
+            # Creates user ids following the DF format
+            userids = []
+            for i in range(0, m):
+                userids.extend([i] * len(items[i]))
+
+            # Flatten the lists to follow the DF input format
+            items = list(itertools.chain.from_iterable(items))
+            ratings = list(itertools.chain.from_iterable(ratings))
 
         if kind == "ratings":
             col_out = self.col_rating
@@ -1,8 +1,14 @@
+import inspect
+import logging
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from numba import njit, prange
+from scipy.sparse import csr_matrix
 
+import tensorflow as tf
 import tensorflow.keras as keras
 from tensorflow.keras.layers import *
 from tensorflow.keras.models import Model
@@ -10,6 +16,62 @@ from tensorflow.keras.losses import binary_crossentropy
 from tensorflow.keras import backend as K
 from tensorflow.keras.callbacks import ReduceLROnPlateau, Callback
 
+from src.models.topk import top_k_batched
+
+
+log = logging.getLogger(__name__)
+
+
+def _recommend_top_k(model, x, k, remove_seen=True, batch_size=1024, return_loss=False):
+    """Returns the indices and scores of the top-k items per user, ordered by score.
+    Scores are obtained for blocks of users, so only one block of the click matrix
+    and of the scores is dense at a time.
+    Args:
+        model: model used to obtain the scores. If return_loss is True, it also returns
+            the loss of each user as second output.
+        x (numpy.ndarray or scipy.sparse.csr_matrix): input click matrix.
+        k (scalar, int32): the number of items to recommend.
+        remove_seen (bool): whether to exclude the items already in the click matrix.
+        batch_size (int): number of users scored at a time, in one call to the model.
+        return_loss (bool): whether to also return the loss of the click matrix,
+            obtained from the same predictions.
+    Returns:
+        numpy.ndarray, numpy.ndarray: indices (int32) and scores of shape (n_users, k),
+        followed by the loss averaged over users (float) if return_loss is True.
+    """
+    x = csr_matrix(x, dtype=np.float32)
+
+    top_items, top_scores = [], []
+    loss = 0.0
+    for start in range(0, x.shape[0], batch_size):
+        x_block = x[start : start + batch_size]
+
+        # obtain scores
+        x_dense = x_block.toarray()
+        outputs = model.predict(x_dense, batch_size=batch_size, verbose=0)
+
+        if return_loss:
+            score, user_loss = outputs
+            loss += np.sum(user_loss, dtype=np.float64)
+        else:
+            score = outputs
+
+        if remove_seen:
+            # if true, it removes items from the train set by setting them to -inf,
+            # visiting only the non-zero elements of the block
+            rows = np.repeat(np.arange(x_block.shape[0]), np.diff(x_block.indptr))
+            score[rows, x_block.indices] = -np.inf
+
+        # get the top k items and their scores, ordered by score
+        block_items, block_scores = top_k_batched(score, k)
+        top_items.append(block_items)
+        top_scores.append(block_scores)
+
+    top_items, top_scores = np.concatenate(top_items), np.concatenate(top_scores)
+    if return_loss:
+        return top_items, top_scores, loss / x.shape[0]
+    return top_items, top_scores
+
 
 class LossHistory(Callback):
     """This class is used for saving the validation loss and the training loss per epoch."""
@@ -29,16 +91,33 @@ class Metrics(Callback):
     """Callback function used to calculate the NDCG@k metric of validation set at the end of each epoch.
     Weights of the model with the highest NDCG@k value is saved."""
 
-    def __init__(self, model, val_tr, val_te, mapper, k, save_path=None):
+    def __init__(
+        self,
+        model,
+        val_tr,
+        val_te,
+        mapper,
+        k,
+        save_path=None,
+        predict_batch_size=1024,
+        eval_model=None,
+    ):
 
         """Initialize the class parameters.
         Args:
             model: trained model for validation.
-            val_tr (numpy.ndarray, float): the click matrix for the validation set training part.
-            val_te (numpy.ndarray, float): the click matrix for the validation set testing part.
+            val_tr (scipy.sparse.csr_matrix, float): the click matrix for the validation
+                set training part.
+            val_te (scipy.sparse.csr_matrix, float): the click matrix for the validation
+                set testing part.
             mapper (AffinityMatrix): the mapper for converting click matrix to dataframe.
             k (int): number of top k items per user (optional).
             save_path (str): Default path to save weights.
+            predict_batch_size (int): Batch size used to obtain the scores of the
+                validation set.
+            eval_model: model sharing the layers of `model` and returning the scores
+                with the training loss (NELBO) of each user. If given, the loss of the
+                validation set training part is reported as `val_loss`.
         """
         # Model
         self.model = model
@@ -50,6 +129,9 @@ class Metrics(Callback):
         self.val_tr = val_tr
         self.val_te = val_te
 
+        # Relevant items of the testing part, constant across epochs
+        self._truth_csr = csr_matrix(val_te != 0)
+
         # Mapper for converting from sparse matrix to dataframe
         self.mapper = mapper
 
@@ -59,6 +141,12 @@ class Metrics(Callback):
         # Options to save the weights of the model for future use
         self.save_path = save_path
 
+        # Batch size for the predictions
+        self.predict_batch_size = predict_batch_size
+
+        # Model used to compute the validation loss
+        self.eval_model = eval_model
+
     def on_train_begin(self, logs={}):
         """Initialise the list for validation NDCG@k."""
         self._data = []
@@ -67,47 +155,47 @@ class Metrics(Callback):
         """Returns the top-k items ordered by a relevancy score.
         Obtained probabilities are used as recommendation score.
         Args:
-            x (numpy.ndarray, int32): input click matrix.
+            x (scipy.sparse.csr_matrix, int32): input click matrix.
             k (scalar, int32): the number of items to recommend.
         Returns:
-            numpy.ndarray: A sparse matrix containing the top_k elements ordered by their score.
+            numpy.ndarray, numpy.ndarray: indices and scores of the top_k elements per
+            user, ordered by their score.
         """
-        # obtain scores
-        score = self.model.predict(x)
-
-        if remove_seen:
-            # if true, it removes items from the train set by setting them to zero
-            seen_mask = np.not_equal(x, 0)
-            score[seen_mask] = 0
-
-        # get the top k items
-        top_items = np.argpartition(-score, range(k), axis=1)[:, :k]
-
-        # get a copy of the score matrix
-        score_c = score.copy()
-
-        # set to zero the k elements
-        score_c[np.arange(score_c.shape[0])[:, None], top_items] = 0
-
-        # set to zeros all elements other then the k
-        top_scores = score - score_c
-
-        return top_scores
+        return _recommend_top_k(
+            self.model,
+            x,
+            k,
+            remove_seen=remove_seen,
+            batch_size=self.predict_batch_size,
+        )
 
     def on_epoch_end(self, batch, logs={}):
         """At the end of each epoch calculate NDCG@k of the validation set.
         If the model performance is improved, the model weights are saved.
         Update the list of validation NDCG@k by adding obtained value.
+        If an evaluation model is given, the NELBO of the training part of the
+        validation set is computed from the same predictions and reported as
+        `val_loss`, so Keras does not need a separate validation pass.
         """
         # recommend top k items based on training part of validation set
-        top_k = self.recommend_k_items(x=self.val_tr, k=self.k, remove_seen=True)
-
-        # convert recommendations from sparse matrix to dataframe
-        top_k_df = self.mapper.map_back_sparse(top_k, kind="prediction")
-        test_df = self.mapper.map_back_sparse(self.val_te, kind="ratings")
+        if self.eval_model is None:
+            top_items, _ = self.recommend_k_items(
+                x=self.val_tr, k=self.k, remove_seen=True
+            )
+        else:
+            top_items, _, val_loss = _recommend_top_k(
+                self.eval_model,
+                self.val_tr,
+                self.k,
+                remove_seen=True,
+                batch_size=self.predict_batch_size,
+                return_loss=True,
+            )
+            if logs is not None:
+                logs["val_loss"] = val_loss
 
-        # calculate NDCG@k
-        NDCG = ndcg_at_k(test_df, top_k_df, col_prediction="prediction", k=self.k)
+        # calculate NDCG@k on the indices of the recommended items
+        NDCG = ndcg_at_k_fast(self._truth_csr, top_items, k=self.k)
 
         # check if there is an improvement in NDCG, if so, update the weights of the saved model
         if NDCG > self.best_ndcg:
@@ -115,7 +203,7 @@ class Metrics(Callback):
 
             # save the weights of the optimal model
             if self.save_path is not None:
-                self.model.save(self.save_path)
+                self.model.save_weights(self.save_path)
 
         self._data.append(NDCG)
 
@@ -125,6 +213,49 @@ class Metrics(Callback):
         return self._data
 
 
+class Sampling(Layer):
+    """Sample epsilon ∼ N (0,I) and compute z via reparametrization trick.
+    The idea is that sampling from N (_mean, _var) is s the same as sampling from
+    _mean + epsilon * _var where epsilon ∼ N(0,I). Epsilon is drawn statelessly from
+    (seed, step), so each batch gets a new sample while the whole sequence stays
+    reproducible for a given seed."""
+
+    def __init__(self, seed=None, **kwargs):
+        super(Sampling, self).__init__(**kwargs)
+        self.seed = np.random.randint(2 ** 31 - 1) if seed is None else seed
+
+    def build(self, input_shape):
+        # number of samples drawn so far, second half of the stateless seed
+        self.step = self.add_weight(
+            name="step",
+            shape=(),
+            dtype=tf.int64,
+            initializer="zeros",
+            trainable=False,
+            aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA,
+        )
+
+    def call(self, inputs):
+        # sampling from latent dimension for decoder/generative part of network
+        _mean, _log_var = inputs
+        step = self.step.assign_add(1)
+        # each replica of a distribution strategy draws from its own seed, there is
+        # no replica context while the model is built under the strategy scope
+        ctx = tf.distribute.get_replica_context()
+        replica_id = ctx.replica_id_in_sync_group if ctx is not None else 0
+        replica_id = tf.cast(replica_id, tf.int64)
+        # drawn in float32 and cast, the same under a mixed precision policy
+        epsilon = tf.random.stateless_normal(
+            shape=tf.shape(_mean),
+            seed=tf.stack([tf.constant(self.seed, dtype=tf.int64) + replica_id, step]),
+            dtype=tf.float32,
+        )
+        epsilon = tf.cast(epsilon, _mean.dtype)
+
+        std = tf.math.exp(0.5 * _log_var)
+        return tf.math.add(_mean, tf.math.multiply(std, epsilon))
+
+
 class StandardVAE:
     """Standard Variational Autoencoders (VAE) for Collaborative Filtering implementation."""
 
@@ -145,6 +276,8 @@ class StandardVAE:
         anneal_cap=1.0,
         seed=None,
         save_path=None,
+        dtype_policy="float32",
+        predict_batch_size=1024,
     ):
 
         """Initialize class parameters.
@@ -154,7 +287,7 @@ class StandardVAE:
             intermediate_dim (int): Dimension of intermediate space.
             latent_dim (int): Dimension of latent space.
             n_epochs (int): Number of epochs for training.
-            batch_size (int): Batch size.
+            batch_size (int): Batch size per device.
             k (int): number of top k items per user.
             verbose (int): Whether to show the training output or not.
             drop_encoder (float): Dropout percentage of the encoder.
@@ -166,10 +299,16 @@ class StandardVAE:
             anneal_cap (float): maximum value that beta can take during annealing process.
             seed (int): Seed.
             save_path (str): Default path to save weights.
+            dtype_policy (str): Keras dtype policy of the encoder/decoder layers.
+                  "mixed_float16" (GPUs with compute capability 7.0+) or
+                  "mixed_bfloat16" enable mixed precision, the output softmax being
+                  always computed in float32.
+            predict_batch_size (int): Batch size used to obtain the scores when
+                  recommending items.
         """
-        # Seed
+        # Seed, the random state shuffles the users of the train set at every epoch
         self.seed = seed
-        np.random.seed(self.seed)
+        self.random_state = np.random.RandomState(self.seed)
 
         # Parameters
         self.n_users = n_users
@@ -178,11 +317,27 @@ class StandardVAE:
         self.latent_dim = latent_dim
         self.n_epochs = n_epochs
         self.batch_size = batch_size
+        self.predict_batch_size = predict_batch_size
         self.k = k
         self.verbose = verbose
 
+        # Data-parallel training on the available GPUs, each replica gets batch_size
+        # users per step. The v1 training loop used in graph mode
+        # (disable_eager_execution) does not support it, so the default strategy is
+        # kept there
+        if tf.executing_eagerly():
+            self.strategy = tf.distribute.MirroredStrategy()
+        else:
+            self.strategy = tf.distribute.get_strategy()
+        self.global_batch_size = self.batch_size * self.strategy.num_replicas_in_sync
+        if self.n_users < self.global_batch_size:
+            raise ValueError(
+                "n_users ({}) must be at least batch_size * number of replicas "
+                "({})".format(self.n_users, self.global_batch_size)
+            )
+
         # Compute samples per epoch
-        self.number_of_batches = self.n_users // self.batch_size
+        self.number_of_batches = self.n_users // self.global_batch_size
 
         # Annealing parameters
         self.anneal_cap = anneal_cap
@@ -205,103 +360,169 @@ class StandardVAE:
         # Path to save optimal model
         self.save_path = save_path
 
+        # Precision of the encoder/decoder layers
+        self.dtype_policy = tf.keras.mixed_precision.Policy(dtype_policy)
+
         # Create StandardVAE model
         self._create_model()
 
     def _create_model(self):
         """Build and compile model."""
-        # Encoding
-        self.x = Input(shape=(self.original_dim,))
-        self.dropout_encoder = Dropout(self.drop_encoder)(self.x)
-        self.h = Dense(self.intermediate_dim, activation="tanh")(self.dropout_encoder)
-        self.z_mean = Dense(self.latent_dim)(self.h)
-        self.z_log_var = Dense(self.latent_dim)(self.h)
-
-        # Sampling
-        self.z = Lambda(self._take_sample, output_shape=(self.latent_dim,))(
-            [self.z_mean, self.z_log_var]
-        )
+        # Variables are mirrored on every available device
+        with self.strategy.scope():
+            # Encoding
+            policy = self.dtype_policy
+            self.x = Input(shape=(self.original_dim,))
+            self.dropout_encoder = Dropout(self.drop_encoder, dtype=policy)(self.x)
+            self.h = Dense(self.intermediate_dim, activation="tanh", dtype=policy)(
+                self.dropout_encoder
+            )
+            self.z_mean = Dense(self.latent_dim, dtype=policy)(self.h)
+            self.z_log_var = Dense(self.latent_dim, dtype=policy)(self.h)
 
-        # Decoding
-        self.h_decoder = Dense(self.intermediate_dim, activation="tanh")
-        self.dropout_decoder = Dropout(self.drop_decoder)
-        self.x_bar = Dense(self.original_dim, activation="softmax")
-        self.h_decoded = self.h_decoder(self.z)
-        self.h_decoded_ = self.dropout_decoder(self.h_decoded)
-        self.x_decoded = self.x_bar(self.h_decoded_)
-
-        # Training
-        self.model = Model(self.x, self.x_decoded)
-        self.model.compile(
-            optimizer=keras.optimizers.Adam(learning_rate=0.001),
-            loss=self._get_vae_loss,
-        )
+            # Sampling
+            self.z = Sampling(seed=self.seed, dtype=policy)(
+                [self.z_mean, self.z_log_var]
+            )
 
-    def _get_vae_loss(self, x, x_bar):
-        """Calculate negative ELBO (NELBO)."""
-        # Reconstruction error: logistic log likelihood
-        reconst_loss = self.original_dim * binary_crossentropy(x, x_bar)
+            # Decoding, the softmax output is kept in float32 for a stable loss
+            self.h_decoder = Dense(
+                self.intermediate_dim, activation="tanh", dtype=policy
+            )
+            self.dropout_decoder = Dropout(self.drop_decoder, dtype=policy)
+            self.x_bar = Dense(self.original_dim, activation="softmax", dtype="float32")
+            self.h_decoded = self.h_decoder(self.z)
+            self.h_decoded_ = self.dropout_decoder(self.h_decoded)
+            self.x_decoded = self.x_bar(self.h_decoded_)
+
+            # Training, scaling the loss to avoid gradients underflowing in float16
+            optimizer = keras.optimizers.Adam(learning_rate=0.001)
+            if policy.compute_dtype == "float16":
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+            self.model = Model(self.x, self.x_decoded)
+            self.model.add_loss(
+                self.beta * K.mean(self._get_kl_loss(self.z_mean, self.z_log_var))
+            )
 
-        # Kullback–Leibler divergence
-        kl_loss = 0.5 * K.sum(
-            -1 - self.z_log_var + K.square(self.z_mean) + K.exp(self.z_log_var), axis=-1
-        )
+            # Evaluation, returning the NELBO of each user along with the scores. It is
+            # computed in the graph by the training loss functions, so that val_loss is
+            # the same quantity as the training loss.
+            self.user_loss = Lambda(
+                lambda t: self._get_vae_loss(t[0], t[1])
+                + self.beta * self._get_kl_loss(t[2], t[3])
+            )([self.x, self.x_decoded, self.z_mean, self.z_log_var])
+            self.eval_model = Model(self.x, [self.x_decoded, self.user_loss])
+            self.model.compile(
+                optimizer=optimizer, loss=self._get_vae_loss, **self._compile_options()
+            )
 
-        return reconst_loss + self.beta * kl_loss
+    def _compile_options(self):
+        """Returns the options of Model.compile that only the TF2 loop supports.
+        A warning is logged when the train step cannot be compiled with XLA."""
+        if not tf.executing_eagerly():
+            log.warning(
+                "The train step is not compiled with XLA in graph mode "
+                "(disable_eager_execution)"
+            )
+            return {}
+
+        # run several steps per call to amortize the Python overhead
+        options = {"steps_per_execution": 16}
+
+        # XLA fuses the dense layers and the sampling, the batch shape being fixed by
+        # the dataset. The compiled step cannot read the variables mirrored on the
+        # other replicas, so it is only used when training on a single device
+        if self.strategy.num_replicas_in_sync > 1:
+            log.warning(
+                "The train step is not compiled with XLA on %d replicas",
+                self.strategy.num_replicas_in_sync,
+            )
+        elif "jit_compile" not in inspect.signature(Model.compile).parameters:
+            # e.g. TF 2.5, whose Model.compile has no jit_compile
+            log.warning(
+                "The train step is not compiled with XLA, Model.compile of "
+                "TensorFlow %s has no jit_compile",
+                tf.__version__,
+            )
+        else:
+            options["jit_compile"] = True
 
-    def _take_sample(self, args):
-        """Sample epsilon ∼ N (0,I) and compute z via reparametrization trick."""
-        """Calculate latent vector using the reparametrization trick.
-           The idea is that sampling from N (_mean, _var) is s the same as sampling from _mean+ epsilon * _var
-           where epsilon ∼ N(0,I)."""
-        # sampling from latent dimension for decoder/generative part of network
-        _mean, _log_var = args
-        epsilon = K.random_normal(
-            shape=(K.shape(_mean)[0], self.latent_dim),
-            mean=0.0,
-            stddev=1.0,
-            seed=self.seed,
-        )
+        return options
 
-        return _mean + K.exp(_log_var / 2) * epsilon
+    def _get_vae_loss(self, x, x_bar):
+        """Calculate the reconstruction part of the negative ELBO (NELBO), the
+        Kullback–Leibler divergence being added to the model with `add_loss`."""
+        # Reconstruction error: logistic log likelihood
+        return self.original_dim * binary_crossentropy(x, x_bar)
+
+    def _get_kl_loss(self, z_mean, z_log_var):
+        """Calculate the Kullback–Leibler divergence part of the NELBO of each user.
+        It only depends on the latent space, so it is added to the model with
+        `add_loss` instead of reading the latent tensors from the loss function, which
+        only graph mode allows."""
+        # Kullback–Leibler divergence, in float32 like the reconstruction error
+        z_mean = K.cast(z_mean, "float32")
+        z_log_var = K.cast(z_log_var, "float32")
+        return 0.5 * K.sum(
+            -1 - z_log_var + K.square(z_mean) + K.exp(z_log_var), axis=-1
+        )
 
-    def nn_batch_generator(self, x_train):
-        """Used for splitting dataset in batches.
+    def _batch_dataset(self, x):
+        """Builds a dataset of batches of users, the click matrix being both input
+        and target. Batches are decompressed from the sparse click matrix one at a
+        time. The users are reshuffled at every pass (i.e. every epoch) and the last
+        incomplete batch is dropped. Each global batch is split between the replicas
+        of the distribution strategy.
         Args:
-            x_train (numpy.ndarray): The click matrix for the train set with float values.
+            x (scipy.sparse.csr_matrix): The click matrix.
+        Returns:
+            tf.distribute.DistributedDataset or tf.data.Dataset (graph mode): Dataset of
+            (x_batch, x_batch) pairs.
         """
-        # Shuffle the batch
-        np.random.seed(self.seed)
-        shuffle_index = np.arange(np.shape(x_train)[0])
-        np.random.shuffle(shuffle_index)
-        x = x_train[shuffle_index, :]
-        y = x_train[shuffle_index, :]
-
-        # Iterate until making a full epoch
-        counter = 0
-        while 1:
-            index_batch = shuffle_index[
-                self.batch_size * counter : self.batch_size * (counter + 1)
-            ]
-            # Decompress batch
-            x_batch = x[index_batch, :]
-            y_batch = y[index_batch, :]
-            counter += 1
-            yield (np.array(x_batch), np.array(y_batch))
-
-            # Stopping rule
-            if counter >= self.number_of_batches:
-                counter = 0
+        batch_size = self.global_batch_size
+
+        def batches():
+            index = self.random_state.permutation(x.shape[0])
+            for batch in range(x.shape[0] // batch_size):
+                rows = index[batch_size * batch : batch_size * (batch + 1)]
+                x_batch = x[rows].toarray()
+                yield x_batch, x_batch
+
+        # fixed batch shape, so that the XLA compiled train step is not recompiled
+        spec = tf.TensorSpec(shape=(batch_size, self.original_dim), dtype=tf.float32)
+        # repeated, the generator drawing a new permutation at every pass
+        dataset = (
+            tf.data.Dataset.from_generator(batches, output_signature=(spec, spec))
+            .repeat()
+            .prefetch(tf.data.experimental.AUTOTUNE)
+        )
+        if not tf.executing_eagerly():
+            return dataset
+        return self.strategy.experimental_distribute_dataset(dataset)
 
     def fit(self, x_train, x_valid, x_val_tr, x_val_te, mapper):
         """Fit model with the train sets and validate on the validation set.
+        The click matrices are held as scipy.sparse.csr_matrix and only made dense
+        one batch at a time.
         Args:
-            x_train (numpy.ndarray): The click matrix for the train set.
-            x_valid (numpy.ndarray): The click matrix for the validation set.
-            x_val_tr (numpy.ndarray): The click matrix for the validation set training part.
-            x_val_te (numpy.ndarray): The click matrix for the validation set testing part.
+            x_train (numpy.ndarray or scipy.sparse.csr_matrix): The click matrix for the
+                train set.
+            x_valid (numpy.ndarray or scipy.sparse.csr_matrix): The click matrix for the
+                validation set.
+                Not used: the validation loss is the NELBO of x_val_tr, computed by the
+                Metrics callback from the predictions it makes for NDCG@k.
+            x_val_tr (numpy.ndarray or scipy.sparse.csr_matrix): The click matrix for
+                the validation set training part.
+            x_val_te (numpy.ndarray or scipy.sparse.csr_matrix): The click matrix for
+                the validation set testing part.
             mapper (object): The mapper for converting click matrix to dataframe. It can be AffinityMatrix.
         """
+        # store the click matrices in sparse format
+        x_train = csr_matrix(x_train, dtype=np.float32)
+        x_val_tr = csr_matrix(x_val_tr, dtype=np.float32)
+        x_val_te = csr_matrix(x_val_te, dtype=np.float32)
+
         # initialise LossHistory used for saving loss of validation and train set per epoch
         history = LossHistory()
 
@@ -314,6 +535,8 @@ class StandardVAE:
             mapper=mapper,
             k=self.k,
             save_path=self.save_path,
+            predict_batch_size=self.predict_batch_size,
+            eval_model=self.eval_model,
         )
 
         self.reduce_lr = ReduceLROnPlateau(
@@ -325,13 +548,14 @@ class StandardVAE:
             return
 
         else:
-            self.model.fit_generator(
-                generator=self.nn_batch_generator(x_train),
-                steps_per_epoch=self.number_of_batches,
+            self.model.fit(
+                self._batch_dataset(x_train),
+                # one pass over the users of the repeated dataset
+                steps_per_epoch=x_train.shape[0] // self.global_batch_size,
                 epochs=self.n_epochs,
                 verbose=self.verbose,
+                # metrics comes first, so val_loss is in the logs of the other callbacks
                 callbacks=[metrics, history, self.reduce_lr],
-                validation_data=(x_valid, x_valid),
             )
 
         # save lists
@@ -351,7 +575,7 @@ class StandardVAE:
 
     def display_metrics(self):
         """Plots:
-        1) Loss per epoch both for validation and train sets
+        1) Loss (NELBO) per epoch both for validation (training part) and train sets
         2) NDCG@k per epoch of the validation set
         """
         # Plot setup
@@ -383,27 +607,27 @@ class StandardVAE:
         """Returns the top-k items ordered by a relevancy score.
         Obtained probabilities are used as recommendation score.
         Args:
-            x (numpy.ndarray): Input click matrix, with `int32` values.
+            x (numpy.ndarray or scipy.sparse.csr_matrix): Input click matrix, with
+                `int32` values.
             k (scalar): The number of items to recommend.
         Returns:
-            numpy.ndarray: A sparse matrix containing the top_k elements ordered by their score.
+            scipy.sparse.csr_matrix: A sparse matrix containing the top_k elements
+            ordered by their score.
         """
 
-        # obtain scores
-        score = self.model.predict(x)
-        if remove_seen:
-            # if true, it removes items from the train set by setting them to zero
-            seen_mask = np.not_equal(x, 0)
-            score[seen_mask] = 0
-        # get the top k items
-        top_items = np.argpartition(-score, range(k), axis=1)[:, :k]
-        # get a copy of the score matrix
-        score_c = score.copy()
-        # set to zero the k elements
-        score_c[np.arange(score_c.shape[0])[:, None], top_items] = 0
-        # set to zeros all elements other then the k
-        top_scores = score - score_c
-        return top_scores
+        # obtain the top k items and their scores
+        top_items, top_scores = _recommend_top_k(
+            self.model,
+            x,
+            k,
+            remove_seen=remove_seen,
+            batch_size=self.predict_batch_size,
+        )
+        # keep only the k elements per user, without the seen items (-inf) that fill
+        # the rows of users with fewer than k unseen items
+        keep = np.isfinite(top_scores)
+        indptr = np.concatenate(([0], np.cumsum(keep.sum(axis=1))))
+        return csr_matrix((top_scores[keep], top_items[keep], indptr), shape=x.shape)
 
     def ndcg_per_epoch(self):
         """Returns the list of NDCG@k at each epoch."""
@@ -417,6 +641,18 @@ DEFAULT_PREDICTION_COL = "prediction"
 DEFAULT_K = 10
 DEFAULT_THRESHOLD = 10
 
+# discount 1 / log(1 + rank) of the ranks 1 to 1023, shared by every NDCG computation
+_LOG_DISCOUNT = 1.0 / np.log1p(np.arange(1, 1024))
+
+
+def _log_discount(k):
+    """Returns the discount of the ranks 1 to k, only computed when k exceeds the
+    precomputed ranks."""
+    if k <= _LOG_DISCOUNT.shape[0]:
+        return _LOG_DISCOUNT[:k]
+    return 1.0 / np.log1p(np.arange(1, k + 1))
+
+
 def ndcg_at_k(
         rating_true,
         rating_pred,
@@ -465,19 +701,88 @@ def ndcg_at_k(
     # calculate discounted gain for hit items
     df_dcg = df_hit.copy()
     # relevance in this case is always 1
-    df_dcg["dcg"] = 1 / np.log1p(df_dcg["rank"])
+    df_dcg["dcg"] = _log_discount(df_dcg["rank"].max())[df_dcg["rank"].values - 1]
     # sum up discount gained to get discount cumulative gain
     df_dcg = df_dcg.groupby(col_user, as_index=False, sort=False).agg({"dcg": "sum"})
     # calculate ideal discounted cumulative gain
     df_ndcg = pd.merge(df_dcg, df_hit_count, on=[col_user])
-    df_ndcg["idcg"] = df_ndcg["actual"].apply(
-        lambda x: sum(1 / np.log1p(range(1, min(x, k) + 1)))
-    )
+    df_ndcg["idcg"] = np.cumsum(_log_discount(k))[
+        np.minimum(df_ndcg["actual"].values, k) - 1
+    ]
 
     # DCG over IDCG is the normalized DCG
     return (df_ndcg["dcg"] / df_ndcg["idcg"]).sum() / n_users
 
 
+def ndcg_at_k_fast(truth_csr, top_k_items, k=DEFAULT_K):
+    """Normalized Discounted Cumulative Gain (nDCG) computed directly on the
+    recommended item indices. Gives the same result as `ndcg_at_k` with
+    relevancy_method="top_k" and the users' ids being the matrix rows, without going
+    through pandas.
+
+    Args:
+        truth_csr (scipy.sparse.csr_matrix, bool): relevant items per user, of shape
+            (n_users, n_items)
+        top_k_items (numpy.ndarray, int32): top k items per user ordered by rank, of
+            shape (n_users, k)
+        k (int): number of top k items per user
+    Returns:
+        float: nDCG at k (min=0, max=1).
+    """
+    top_k_items = np.ascontiguousarray(top_k_items[:, :k])
+    k = top_k_items.shape[1]
+    log_discount = _log_discount(k)
+
+    # the kernel looks up the hits by binary search in each row of the truth
+    if not truth_csr.has_sorted_indices:
+        truth_csr = truth_csr.sorted_indices()
+
+    # only users with relevant items are evaluated
+    n_users = np.count_nonzero(np.diff(truth_csr.indptr))
+    if n_users == 0:
+        return 0.0
+
+    ndcg = _ndcg_kernel(
+        truth_csr.indptr, truth_csr.indices, top_k_items, log_discount, k
+    )
+    return ndcg.sum() / n_users
+
+
+@njit(parallel=True, fastmath=True)
+def _ndcg_kernel(truth_indptr, truth_indices, top_k_items, log_discount, k):
+    """nDCG at k of every user, 0 for users without relevant items."""
+    n_users = top_k_items.shape[0]
+    out = np.zeros(n_users)
+    for u in prange(n_users):
+        start, end = truth_indptr[u], truth_indptr[u + 1]
+        actual = end - start
+        if actual > 0:
+            truth = truth_indices[start:end]
+
+            # calculate discounted gain for hit items, relevance is always 1
+            dcg = 0.0
+            for j in range(k):
+                item = top_k_items[u, j]
+                lo, hi = 0, actual
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if truth[mid] < item:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                if lo < actual and truth[lo] == item:
+                    dcg += log_discount[j]
+
+            # calculate ideal discounted cumulative gain
+            idcg = 0.0
+            for j in range(min(actual, k)):
+                idcg += log_discount[j]
+
+            # DCG over IDCG is the normalized DCG
+            out[u] = dcg / idcg
+    return out
+
+
 def merge_ranking_true_pred(
     rating_true,
     rating_pred,
@@ -507,7 +812,9 @@ def merge_ranking_true_pred(
     """
 
     # Make sure the prediction and true data frames have the same set of users
-    common_users = set(rating_true[col_user]).intersection(set(rating_pred[col_user]))
+    common_users = np.intersect1d(
+        rating_true[col_user].values, rating_pred[col_user].values
+    )
     rating_true_common = rating_true[rating_true[col_user].isin(common_users)]
     rating_pred_common = rating_pred[rating_pred[col_user].isin(common_users)]
     n_users = len(common_users)
@@ -530,24 +837,43 @@ def merge_ranking_true_pred(
         col_rating=col_prediction,
         k=top_k,
     )
-    df_hit = pd.merge(df_hit, rating_true_common, on=[col_user, col_item])[
-        [col_user, col_item, "rank"]
-    ]
 
-    # count the number of hits vs actual relevant items per user
-    df_hit_count = pd.merge(
-        df_hit.groupby(col_user, as_index=False)[col_user].agg({"hit": "count"}),
-        rating_true_common.groupby(col_user, as_index=False)[col_user].agg(
-            {"actual": "count"}
-        ),
-        on=col_user,
+    # Keep the predicted items that are in the true data frame. Users and items of both
+    # data frames are factorized to integer codes, so the join runs on a single int64
+    # (user, item) key.
+    user_codes, user_uniques = pd.factorize(
+        pd.concat([df_hit[col_user], rating_true_common[col_user]])
+    )
+    item_codes, item_uniques = pd.factorize(
+        pd.concat([df_hit[col_item], rating_true_common[col_item]])
+    )
+    keys = user_codes.astype(np.int64) * len(item_uniques) + item_codes
+    n_pred = df_hit.shape[0]
+    is_hit = np.isin(keys[:n_pred], keys[n_pred:])
+    df_hit = df_hit[is_hit][[col_user, col_item, "rank"]].reset_index(drop=True)
+
+    # count the number of hits vs actual relevant items per user, indexed by the
+    # shared user codes
+    hit = np.bincount(user_codes[:n_pred][is_hit], minlength=len(user_uniques))
+    actual = np.bincount(user_codes[n_pred:], minlength=len(user_uniques))
+    has_hit = hit > 0
+    df_hit_count = pd.DataFrame(
+        {
+            col_user: np.asarray(user_uniques)[has_hit],
+            "hit": hit[has_hit],
+            "actual": actual[has_hit],
+        }
     )
 
     return df_hit, df_hit_count, n_users
 
 
 def get_top_k_items(
-        dataframe, col_user=DEFAULT_USER_COL, col_rating=DEFAULT_RATING_COL, k=DEFAULT_K
+        dataframe,
+        col_user=DEFAULT_USER_COL,
+        col_rating=DEFAULT_RATING_COL,
+        k=DEFAULT_K,
+        col_item=DEFAULT_ITEM_COL,
 ):
     """Get the input customer-item-rating tuple in the format of Pandas
     DataFrame, output a Pandas DataFrame in the dense format of top k items
@@ -557,22 +883,44 @@ def get_top_k_items(
         If it is implicit rating, just append a column of constants to be
         ratings.
     Args:
-        dataframe (pandas.DataFrame): DataFrame of rating data (in the format
-        customerID-itemID-rating)
+        dataframe (pandas.DataFrame or numpy.ndarray): DataFrame of rating data (in
+        the format customerID-itemID-rating), or a score matrix of shape
+        (n_users, n_items) whose row and column indices are used as user and item ids
         col_user (str): column name for user
         col_rating (str): column name for rating
         k (int or None): number of items for each user; None means that the input has already been
         filtered out top k items and sorted by ratings and there is no need to do that again.
+        col_item (str): column name for item, only used when dataframe is a score matrix
     Returns:
         pandas.DataFrame: DataFrame of top k items for each user, sorted by `col_user` and `rank`
     """
+    if isinstance(dataframe, np.ndarray):
+        if k is None:
+            raise ValueError("k is required to get the top k items of a score matrix")
+
+        # top k items of every row at once, already ordered by score
+        n_users = dataframe.shape[0]
+        top_items, top_scores = top_k_batched(dataframe, k)
+        k = top_items.shape[1]
+        return pd.DataFrame(
+            {
+                col_user: np.repeat(np.arange(n_users), k),
+                col_item: top_items.ravel(),
+                col_rating: top_scores.ravel(),
+                "rank": np.tile(np.arange(1, k + 1), n_users),
+            }
+        )
+
     # Sort dataframe by col_user and (top k) col_rating
     if k is None:
         top_k_items = dataframe
     else:
         top_k_items = (
-            dataframe.groupby(col_user, as_index=False)
-                .apply(lambda x: x.nlargest(k, col_rating))
+            dataframe.sort_values(
+                [col_user, col_rating], ascending=[True, False], kind="mergesort"
+            )
+                .groupby(col_user, sort=False)
+                .head(k)
                 .reset_index(drop=True)
         )
     # Add ranks
@@ -0,0 +1,98 @@
+/*
+ * Batched top-k selection over a dense, row-major float32 score matrix.
+ *
+ * Each row is scanned once. A min-heap of size k holds the best scores seen
+ * so far; with AVX2, 8 scores at a time are compared against the heap
+ * minimum and only the lanes that beat it touch the heap. The heap is then
+ * sorted in place so that every output row is ordered by decreasing score.
+ *
+ * Build with `make topk` (see the Makefile).
+ */
+#include <stddef.h>
+
+#ifdef __AVX2__
+#include <immintrin.h>
+#endif
+
+static void sift_down(float *val, int *idx, int n, int i)
+{
+    for (;;) {
+        int l = 2 * i + 1;
+        int r = l + 1;
+        int m = i;
+        float tv;
+        int ti;
+
+        if (l < n && val[l] < val[m])
+            m = l;
+        if (r < n && val[r] < val[m])
+            m = r;
+        if (m == i)
+            return;
+
+        tv = val[i]; val[i] = val[m]; val[m] = tv;
+        ti = idx[i]; idx[i] = idx[m]; idx[m] = ti;
+        i = m;
+    }
+}
+
+static void replace_min(float *val, int *idx, int k, float v, int j)
+{
+    val[0] = v;
+    idx[0] = j;
+    sift_down(val, idx, k, 0);
+}
+
+static void topk_row(const float *row, int V, int k, int *out_idx, float *out_val)
+{
+    int j;
+
+    /* seed the heap with the first k scores */
+    for (j = 0; j < k; j++) {
+        out_val[j] = row[j];
+        out_idx[j] = j;
+    }
+    for (j = k / 2 - 1; j >= 0; j--)
+        sift_down(out_val, out_idx, k, j);
+
+    j = k;
+#ifdef __AVX2__
+    for (; j + 8 <= V; j += 8) {
+        __m256 x = _mm256_loadu_ps(row + j);
+        __m256 t = _mm256_set1_ps(out_val[0]);
+        int mask = _mm256_movemask_ps(_mm256_cmp_ps(x, t, _CMP_GT_OQ));
+
+        while (mask) {
+            int lane = __builtin_ctz(mask);
+            mask &= mask - 1;
+            /* the threshold may have risen since the compare */
+            if (row[j + lane] > out_val[0])
+                replace_min(out_val, out_idx, k, row[j + lane], j + lane);
+        }
+    }
+#endif
+    for (; j < V; j++) {
+        if (row[j] > out_val[0])
+            replace_min(out_val, out_idx, k, row[j], j);
+    }
+
+    /* heap sort: moving the minimum to the back leaves a decreasing order */
+    for (j = k - 1; j > 0; j--) {
+        float tv = out_val[0];
+        int ti = out_idx[0];
+        out_val[0] = out_val[j]; out_val[j] = tv;
+        out_idx[0] = out_idx[j]; out_idx[j] = ti;
+        sift_down(out_val, out_idx, j, 0);
+    }
+}
+
+void fast_topk_batched(const float *scores, int B, int V, int k,
+                       int *out_idx, float *out_val)
+{
+    int b;
+
+    for (b = 0; b < B; b++) {
+        topk_row(scores + (size_t)b * V, V, k,
+                 out_idx + (size_t)b * k, out_val + (size_t)b * k);
+    }
+}
@@ -0,0 +1,66 @@
+import ctypes
+import os
+
+import numpy as np
+from numpy.ctypeslib import ndpointer
+
+
+# compiled with `make topk`; a numpy implementation is used when it is missing
+_LIB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fast_topk_batched.so"
+)
+
+
+def _load_kernel():
+    """Load the native top-k kernel, returns None if it has not been built."""
+    try:
+        lib = ctypes.CDLL(_LIB_PATH)
+    except OSError:
+        return None
+
+    kernel = lib.fast_topk_batched
+    kernel.argtypes = [
+        ndpointer(np.float32, flags="C_CONTIGUOUS"),
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ndpointer(np.int32, flags="C_CONTIGUOUS"),
+        ndpointer(np.float32, flags="C_CONTIGUOUS"),
+    ]
+    kernel.restype = None
+    return kernel
+
+
+_fast_topk_batched = _load_kernel()
+
+
+def top_k_batched(score, k):
+    """Returns the top-k columns of every row of a score matrix.
+    Args:
+        score (numpy.ndarray, float): dense score matrix of shape (n_users, n_items);
+            the native kernel is used for float32 scores.
+        k (int): number of top k items per user.
+    Returns:
+        numpy.ndarray, numpy.ndarray: indices (int32) and values of the top k items
+        per user, both of shape (n_users, k) and ordered by decreasing score.
+    """
+    if k < 1:
+        raise ValueError("k must be at least 1, got {}".format(k))
+
+    n_users, n_items = score.shape
+    k = min(k, n_items)
+
+    if _fast_topk_batched is not None and score.dtype == np.float32:
+        score = np.ascontiguousarray(score)
+        top_items = np.empty((n_users, k), dtype=np.int32)
+        top_scores = np.empty((n_users, k), dtype=np.float32)
+        _fast_topk_batched(score, n_users, n_items, k, top_items, top_scores)
+        return top_items, top_scores
+
+    # partition the k largest scores to the end of each row, then sort only those
+    top_items = np.argpartition(score, n_items - k, axis=1)[:, n_items - k:]
+    top_scores = np.take_along_axis(score, top_items, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top_items = np.take_along_axis(top_items, order, axis=1).astype(np.int32)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    return top_items, top_scores